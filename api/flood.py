@@ -3,104 +3,419 @@ Vercel Serverless Function: Flood Hazard Level by IP
 With comprehensive error logging
 """
 
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from http.server import BaseHTTPRequestHandler
+import functools
+import hashlib
 import json
-import urllib.request
-import urllib.error
 import urllib.parse
 import math
+import mmap
+import os
 import sys
+import threading
+import time
 import traceback
+from typing import Any
+
+import msgspec
+import numpy as np
+import urllib3
 
 FLOOD_DATA_URL = "https://www.dropbox.com/scl/fi/iuf8evgvxf7hhas249vkb/flood_hazard_data.json?rlkey=qzsz2mzox5vxbips03vzv67v1&st=0ybzj3fe&dl=1"
 
-_flood_data_cache = None
+# /tmp survives between invocations on the same instance, so a new process
+# there can skip the Dropbox download; see flood_data_path
+FLOOD_DATA_DIR = "/tmp"
+
+# Cached copies older than this (seconds) are downloaded again
+FLOOD_DATA_MAX_AGE = 6 * 60 * 60
+
+# After a failed load, requests within this many seconds fail straight away
+# instead of queueing up to repeat the same download
+FLOOD_DATA_RETRY_AFTER = 30
+
+# Smaller datasets are served by a binary search over the zones sorted by
+# min x. Measured on synthetic data, the scan is as fast as the grid up to
+# about 5000 zones and the grid pulls ahead after that
+GRID_MIN_FEATURES = 5000
+
+# Zones covering more grid cells than this move up to the next grid level,
+# whose cells are GRID_LEVEL_FACTOR times wider
+GRID_MAX_CELLS_PER_ZONE = 64
+GRID_LEVEL_FACTOR = 8
+
+# Below this many vertices NumPy's per-call overhead outweighs the
+# vectorised loop, so small rings stay as plain lists
+NUMPY_RING_MIN_VERTICES = 128
+
+# Shared across warm invocations so repeat calls reuse open TLS connections.
+# Only failed connects are retried: a read timeout has already used up the
+# request's time budget, so retrying it would multiply the wait
+_http = urllib3.PoolManager(
+    maxsize=4,
+    retries=urllib3.Retry(connect=2, read=False, redirect=5, backoff_factor=0.2),
+)
+
+# Ask for compressed bodies; urllib3 decompresses them as they are read
+_dropbox_headers = urllib3.make_headers(accept_encoding=True, user_agent='Mozilla/5.0')
+_ipapi_headers = urllib3.make_headers(accept_encoding=True)
+
+# Runs the cold-start flood data download alongside the IP lookup
+_executor = ThreadPoolExecutor(max_workers=2)
+
+# Held while loading so concurrent cold-start requests share one download
+_flood_data_lock = threading.Lock()
+_flood_index_cache = None
+_flood_data_failed_at = None
+
+
+# Flood zones are decoded straight into these structs rather than dicts, so
+# the query path uses slot attribute access instead of string-keyed lookups
+class Bounds(msgspec.Struct):
+    minx: float
+    miny: float
+    maxx: float
+    maxy: float
+
+
+class Geometry(msgspec.Struct):
+    type: str
+    coordinates: list = []
+
+
+class FloodZone(msgspec.Struct):
+    bounds: Bounds
+    # A null geometry leaves the zone with no rings instead of failing the
+    # whole file
+    geometry: Geometry | None = None
+    hazard: Any = None
+    # Filled in by prepare_rings
+    rings: list = []
+
+
+# Everything find_flood_hazard needs for one dataset, built together by
+# build_flood_index so the lookup structures always match their zones
+class FloodIndex(msgspec.Struct):
+    zones: list
+    # (minx, miny, maxx, maxy) over all zones, None when there are none
+    extent: Any
+    # Zone bounds as [minx, miny, maxx, maxy] rows in min-x order, with the
+    # permutation back to file order
+    minx_order: Any
+    sorted_bounds: Any
+    sorted_minx: Any
+    # Grid levels from fine to coarse as (cell_size, cells), where cells maps
+    # (ix, iy) -> (zone positions, their bounds as [minx, miny, maxx, maxy]
+    # rows); None when the sorted scan is used
+    grid: Any = None
 
 
 def load_flood_data():
-    global _flood_data_cache
-    if _flood_data_cache is not None:
+    global _flood_index_cache, _flood_data_failed_at
+    if _flood_index_cache is not None:
         print("Using cached flood data")
-        return _flood_data_cache
+        return _flood_index_cache
+    
+    with _flood_data_lock:
+        # Another thread may have finished loading while this one waited
+        if _flood_index_cache is not None:
+            print("Using cached flood data")
+            return _flood_index_cache
+        if _flood_data_failed_at is not None and time.monotonic() - _flood_data_failed_at < FLOOD_DATA_RETRY_AFTER:
+            print("Flood data failed to load moments ago, not retrying yet")
+            return None
+        
+        try:
+            path = flood_data_path()
+            flood_data = read_cached_flood_data(path)
+            if flood_data is None:
+                print(f"Loading flood data from Dropbox...")
+                tmp_path = f"{path}.{os.getpid()}"
+                try:
+                    download_flood_data_file(tmp_path)
+                    flood_data = read_flood_data_file(tmp_path)
+                    # Only kept once it has parsed, so a bad download is not reused
+                    os.replace(tmp_path, path)
+                finally:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+            print(f"Successfully loaded {len(flood_data)} flood zones")
+            prepare_rings(flood_data)
+            _flood_index_cache = build_flood_index(flood_data)
+            _flood_data_failed_at = None
+            return _flood_index_cache
+        except Exception as e:
+            print(f"ERROR loading flood data: {type(e).__name__}: {e}")
+            traceback.print_exc()
+            _flood_data_failed_at = time.monotonic()
+            return None
+
+
+def flood_data_path():
+    # Keyed on the URL so pointing at another dataset never reuses the old file
+    digest = hashlib.sha256(FLOOD_DATA_URL.encode()).hexdigest()[:16]
+    return os.path.join(FLOOD_DATA_DIR, f"flood_data_{digest}.json")
+
+
+def read_cached_flood_data(path):
+    try:
+        age = time.time() - os.path.getmtime(path)
+    except FileNotFoundError:
+        return None
+    if age > FLOOD_DATA_MAX_AGE:
+        print(f"Cached flood data is {age / 3600:.1f}h old, refreshing")
+        return None
     
     try:
-        print(f"Loading flood data from Dropbox...")
-        request = urllib.request.Request(FLOOD_DATA_URL, headers={'User-Agent': 'Mozilla/5.0'})
-        with urllib.request.urlopen(request, timeout=30) as response:
-            data = response.read().decode()
-            _flood_data_cache = json.loads(data)
-        print(f"Successfully loaded {len(_flood_data_cache)} flood zones")
-        return _flood_data_cache
+        print(f"Loading flood data from {path}...")
+        return read_flood_data_file(path)
     except Exception as e:
-        print(f"ERROR loading flood data: {type(e).__name__}: {e}")
+        # Drop the bad copy so this and later cold starts download afresh
+        print(f"ERROR reading cached flood data, downloading again: {type(e).__name__}: {e}")
         traceback.print_exc()
-        return []
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return None
 
 
-def get_ip_location(ip):
+def download_flood_data_file(path):
+    # Streamed to disk in chunks so the whole body is never held in memory
+    response = _http.request(
+        'GET', FLOOD_DATA_URL, headers=_dropbox_headers,
+        timeout=urllib3.Timeout(connect=5.0, total=30.0), preload_content=False,
+    )
     try:
-        print(f"Looking up location for IP: {ip}")
-        url = f"https://ipapi.co/{ip}/json/"
-        with urllib.request.urlopen(url, timeout=5) as response:
-            data = json.loads(response.read().decode())
-        
-        if 'latitude' in data and 'longitude' in data:
-            print(f"Found location: {data.get('city')}, {data.get('region')}")
-            return {
-                'latitude': data['latitude'],
-                'longitude': data['longitude'],
-                'city': data.get('city', 'Unknown'),
-                'region': data.get('region', 'Unknown'),
-                'country': data.get('country_name', 'Unknown')
-            }
+        if response.status != 200:
+            raise urllib3.exceptions.HTTPError(f"HTTP {response.status} from Dropbox")
+        with open(path, 'wb') as f:
+            for chunk in response.stream(1 << 20):
+                f.write(chunk)
+    finally:
+        response.release_conn()
+
+
+def read_flood_data_file(path):
+    # Decoding straight from the page cache skips reading the file into a
+    # bytes copy first
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        return msgspec.json.decode(buf, type=list[FloodZone])
+
+
+def prepare_rings(flood_data, numpy_min_vertices=NUMPY_RING_MIN_VERTICES):
+    # Polygons and MultiPolygons both become one flat list of prepared rings,
+    # so the query path never looks at the geometry type
+    for feature in flood_data:
+        geometry = feature.geometry
+        if geometry is None:
+            feature.rings = []
+            continue
+        if geometry.type == 'Polygon':
+            polygons = [geometry.coordinates]
+        elif geometry.type == 'MultiPolygon':
+            polygons = geometry.coordinates
         else:
-            print(f"No coordinates in response: {data}")
+            polygons = []
+        feature.rings = [
+            prepare_ring(ring, numpy_min_vertices)
+            for polygon in polygons for ring in polygon if ring
+        ]
+        # The nested coordinate lists dwarf the prepared rings and are not
+        # read again, so let them go
+        geometry.coordinates = []
+
+
+def prepare_ring(ring, numpy_min_vertices=NUMPY_RING_MIN_VERTICES):
+    # Precompute every edge once: edge i runs from (xs1[i], ys1[i]) to
+    # (xs[i], ys[i]) and the ray at height y crosses it at
+    # xs1[i] + (y - ys1[i]) * slopes[i], so queries never divide. Large rings
+    # keep (ys, ys1, xs1, slopes) as arrays for point_in_polygon_np, small
+    # ones a list of (y1, y2, x1, slope) tuples for point_in_polygon. The
+    # ring comes back as (minx, miny, maxx, maxy, edges) so holes and parts
+    # the point is nowhere near are rejected on their bbox alone
+    coords = np.asarray(ring, dtype=np.float64)
+    xs = np.ascontiguousarray(coords[:, 0])
+    ys = np.ascontiguousarray(coords[:, 1])
+    xs1 = np.roll(xs, 1)
+    ys1 = np.roll(ys, 1)
+    dy = ys - ys1
+    # Horizontal edges are never crossed, so their slope is never read
+    slopes = (xs - xs1) / np.where(dy == 0, 1.0, dy)
+    if len(ring) < numpy_min_vertices:
+        edges = list(zip(ys1.tolist(), ys.tolist(), xs1.tolist(), slopes.tolist()))
+    else:
+        edges = (ys, ys1, xs1, slopes)
+    return (float(xs.min()), float(ys.min()), float(xs.max()), float(ys.max()), edges)
+
+
+def build_flood_index(flood_data, grid_min_features=GRID_MIN_FEATURES):
+    # One (N, 4) array of [minx, miny, maxx, maxy] rows, position i being
+    # flood_data[i], so the bbox prefilter is a handful of vector compares
+    bounds = np.array([
+        (b.minx, b.miny, b.maxx, b.maxy)
+        for b in (feature.bounds for feature in flood_data)
+    ], dtype=np.float64).reshape(-1, 4)
+    minx_order = np.argsort(bounds[:, 0], kind='stable')
+    sorted_bounds = bounds[minx_order]
+    flood_index = FloodIndex(
+        zones=flood_data,
+        extent=None,
+        minx_order=minx_order,
+        sorted_bounds=sorted_bounds,
+        sorted_minx=np.ascontiguousarray(sorted_bounds[:, 0]),
+    )
+    if len(bounds):
+        flood_index.extent = (
+            float(bounds[:, 0].min()), float(bounds[:, 1].min()),
+            float(bounds[:, 2].max()), float(bounds[:, 3].max()),
+        )
+    if len(flood_data) < grid_min_features:
+        print(f"Using sorted min-x scan for {len(flood_data)} zones")
+        return flood_index
+    
+    # The finest level is sized to a typical zone. Zones too big for a level
+    # go up to a coarser one, so every zone sits in a few cells of exactly one
+    # level and a lookup checks one cell per level
+    sizes = np.maximum(bounds[:, 2] - bounds[:, 0], bounds[:, 3] - bounds[:, 1])
+    cell_size = float(np.median(sizes)) or 1.0
+    remaining = np.arange(len(bounds))
+    levels = []
+    while len(remaining):
+        cells = np.floor(bounds[remaining] / cell_size).astype(np.int64)
+        spans = (cells[:, 2] - cells[:, 0] + 1) * (cells[:, 3] - cells[:, 1] + 1)
+        fits = spans <= GRID_MAX_CELLS_PER_ZONE
+        grid = defaultdict(list)
+        # Zones are visited in file order, so every cell list comes out sorted
+        for i, (ix0, iy0, ix1, iy1) in zip(remaining[fits].tolist(), cells[fits].tolist()):
+            for ix in range(ix0, ix1 + 1):
+                for iy in range(iy0, iy1 + 1):
+                    grid[(ix, iy)].append(i)
+        levels.append((cell_size, {
+            cell: (np.array(zones, dtype=np.intp), bounds[zones])
+            for cell, zones in grid.items()
+        }))
+        remaining = remaining[~fits]
+        cell_size *= GRID_LEVEL_FACTOR
+    print(f"Built {len(levels)}-level flood grid over {len(flood_data)} zones")
+    flood_index.grid = levels
+    return flood_index
+
+
+def get_ip_location(ip):
+    try:
+        # Copied so a caller can't alter the cached entry
+        return dict(lookup_ip_location(ip))
+    except LookupError as e:
+        print(e)
     except Exception as e:
         print(f"ERROR getting IP location: {type(e).__name__}: {e}")
         traceback.print_exc()
     return None
 
 
-def lat_lon_to_web_mercator(lat, lon):
-    R = 6378137.0
-    x = R * math.radians(lon)
-    lat_rad = math.radians(lat)
-    y = R * math.log(math.tan(math.pi / 4 + lat_rad / 2))
+# Failed lookups raise, and lru_cache never caches an exception, so a
+# rate-limited or empty answer from ipapi.co is retried on the next request
+@functools.lru_cache(maxsize=2048)
+def lookup_ip_location(ip):
+    print(f"Looking up location for IP: {ip}")
+    url = f"https://ipapi.co/{ip}/json/"
+    response = _http.request(
+        'GET', url, headers=_ipapi_headers,
+        timeout=urllib3.Timeout(connect=1.0, total=5.0),
+    )
+    if response.status != 200:
+        raise urllib3.exceptions.HTTPError(f"HTTP {response.status} from ipapi.co")
+    data = json.loads(response.data)
+    
+    if 'latitude' not in data or 'longitude' not in data:
+        raise LookupError(f"No coordinates in response: {data}")
+    print(f"Found location: {data.get('city')}, {data.get('region')}")
+    return {
+        'latitude': data['latitude'],
+        'longitude': data['longitude'],
+        'city': data.get('city', 'Unknown'),
+        'region': data.get('region', 'Unknown'),
+        'country': data.get('country_name', 'Unknown')
+    }
+
+
+# The defaults bind the constants and math functions as locals once, at
+# definition time, instead of looking them up on every call
+def lat_lon_to_web_mercator(lat, lon, R=6378137.0, PI_4=math.pi / 4,
+                            radians=math.radians, log=math.log, tan=math.tan):
+    x = R * radians(lon)
+    y = R * log(tan(PI_4 + radians(lat) * 0.5))
     return x, y
 
 
-def point_in_polygon(x, y, polygon):
-    inside = False
-    n = len(polygon)
-    x1, y1 = polygon[-1]
-    for i in range(n):
-        x2, y2 = polygon[i]
-        if min(y1, y2) < y <= max(y1, y2):
-            if x <= max(x1, x2):
-                if y1 != y2:
-                    x_intersection = (y - y1) * (x2 - x1) / (y2 - y1) + x1
-                if x1 == x2 or x <= x_intersection:
-                    inside = not inside
-        x1, y1 = x2, y2
-    return inside
+def point_in_polygon(x, y, edges):
+    # Winding number: edges crossing the ray to the right of the point count
+    # +1 going up and -1 going down, so self-intersecting rings still come
+    # out inside where they wrap the point, unlike an even-odd count
+    winding = 0
+    for y1, y2, x1, slope in edges:
+        # Edges entirely above or below y are skipped on one compare
+        if (y1 > y) != (y2 > y) and x <= x1 + (y - y1) * slope:
+            winding += 1 if y2 > y else -1
+    return winding != 0
+
+
+def point_in_polygon_np(x, y, ys, ys1, xs1, slopes):
+    # Vectorised form of point_in_polygon over a ring's edge arrays
+    right = x <= xs1 + (y - ys1) * slopes
+    up = (ys1 <= y) & (ys > y) & right
+    down = (ys1 > y) & (ys <= y) & right
+    return np.count_nonzero(up) != np.count_nonzero(down)
 
 
-def find_flood_hazard(lat, lon, flood_data):
+def ring_contains(x, y, ring):
+    minx, miny, maxx, maxy, edges = ring
+    if not (minx <= x <= maxx and miny <= y <= maxy):
+        return False
+    if isinstance(edges, list):
+        return point_in_polygon(x, y, edges)
+    return point_in_polygon_np(x, y, *edges)
+
+
+def find_flood_hazard(lat, lon, flood_index):
     try:
         x, y = lat_lon_to_web_mercator(lat, lon)
         print(f"Checking coordinates: lat={lat}, lon={lon}, x={x:.2f}, y={y:.2f}")
         
-        for feature in flood_data:
-            bounds = feature['bounds']
-            if not (bounds['minx'] <= x <= bounds['maxx'] and bounds['miny'] <= y <= bounds['maxy']):
-                continue
-            
-            geometry = feature['geometry']
-            if geometry['type'] == 'Polygon':
-                for ring in geometry['coordinates']:
-                    if point_in_polygon(x, y, ring):
-                        print(f"Found flood zone: {feature['hazard']}")
-                        return feature['hazard']
+        # Most lookups from outside the covered area end here
+        flood_data = flood_index.zones
+        if flood_index.extent is not None:
+            minx, miny, maxx, maxy = flood_index.extent
+            if not (minx <= x <= maxx and miny <= y <= maxy):
+                print("Outside flood data coverage")
+                return None
+        
+        if flood_index.grid is not None:
+            hits = []
+            for cell_size, cells in flood_index.grid:
+                cell = cells.get((math.floor(x / cell_size), math.floor(y / cell_size)))
+                if cell is not None:
+                    zones, bounds = cell
+                    mask = (bounds[:, 0] <= x) & (x <= bounds[:, 2]) & (bounds[:, 1] <= y) & (y <= bounds[:, 3])
+                    hits.append(zones[mask])
+            # Re-sorted across levels so overlapping zones still resolve in file order
+            candidates = np.sort(np.concatenate(hits)) if hits else ()
+        else:
+            # Only zones starting at or left of x can contain it
+            hi = np.searchsorted(flood_index.sorted_minx, x, side='right')
+            bounds = flood_index.sorted_bounds[:hi]
+            mask = (x <= bounds[:, 2]) & (bounds[:, 1] <= y) & (y <= bounds[:, 3])
+            candidates = np.sort(flood_index.minx_order[:hi][mask])
+        
+        for i in candidates:
+            feature = flood_data[i]
+            for ring in feature.rings:
+                if ring_contains(x, y, ring):
+                    print(f"Found flood zone: {feature.hazard}")
+                    return feature.hazard
         
         print("No flood zone found")
         return None
@@ -117,6 +432,10 @@ class handler(BaseHTTPRequestHandler):
         print(f"Headers: {dict(self.headers)}")
         
         try:
+            # Start loading flood data while the IP is resolved; this is
+            # immediate once the cache is warm
+            flood_data_future = _executor.submit(load_flood_data)
+            
             # Parse query parameters
             parsed = urllib.parse.urlparse(self.path)
             params = urllib.parse.parse_qs(parsed.query)
@@ -140,14 +459,14 @@ class handler(BaseHTTPRequestHandler):
                 return
             
             # Load flood data
-            flood_data = load_flood_data()
-            if not flood_data:
+            flood_index = flood_data_future.result()
+            if flood_index is None or not flood_index.zones:
                 print("Failed to load flood data")
                 self.send_json_response(500, {'error': 'Failed to load flood data'})
                 return
             
             # Find hazard
-            hazard = find_flood_hazard(location['latitude'], location['longitude'], flood_data)
+            hazard = find_flood_hazard(location['latitude'], location['longitude'], flood_index)
             
             # Send response
             response = {
@@ -167,11 +486,13 @@ class handler(BaseHTTPRequestHandler):
     
     def send_json_response(self, code, data):
         try:
+            body = json.dumps(data, indent=2).encode()
             self.send_response(code)
             self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
             self.send_header('Access-Control-Allow-Origin', '*')
             self.end_headers()
-            self.wfile.write(json.dumps(data, indent=2).encode())
+            self.wfile.write(body)
         except Exception as e:
             print(f"ERROR sending response: {e}")
             traceback.print_exc()
@@ -0,0 +1,183 @@
+"""
+Regression check for the flood zone lookup
+
+Compares find_flood_hazard on both index paths (grid and sorted min-x scan)
+and both ring kernels (plain list and NumPy) against a brute-force scan of
+the raw GeoJSON-style zones. Run with: python -m unittest discover tests
+"""
+
+import contextlib
+import io
+import math
+import os
+import random
+import sys
+import unittest
+
+import msgspec
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'api'))
+
+import flood  # noqa: E402
+
+R = 6378137.0
+HAZARDS = ['A', 'AE', 'AO', 'VE', 'X']
+# Centre of the self-intersecting pentagram zone added by make_zones
+STAR_CENTRE = (-9.0e6, 4.0e6)
+
+
+def star_ring(rng, cx, cy, radius, n):
+    ring = []
+    for i in range(n):
+        angle = 2 * math.pi * i / n
+        r = radius * rng.uniform(0.4, 1.0)
+        ring.append([cx + r * math.cos(angle), cy + r * math.sin(angle)])
+    ring.append(list(ring[0]))
+    return ring
+
+
+def pentagram_ring(cx, cy, radius):
+    # Joining every second point of a pentagon wraps the centre twice, so
+    # even-odd calls it outside while the winding number calls it inside
+    ring = [
+        [cx + radius * math.cos(math.pi / 2 + 4 * math.pi * k / 5),
+         cy + radius * math.sin(math.pi / 2 + 4 * math.pi * k / 5)]
+        for k in range(5)
+    ]
+    ring.append(list(ring[0]))
+    return ring
+
+
+def make_zone(geometry, hazard):
+    polygons = [geometry['coordinates']] if geometry['type'] == 'Polygon' else geometry['coordinates']
+    xs = [p[0] for polygon in polygons for ring in polygon for p in ring]
+    ys = [p[1] for polygon in polygons for ring in polygon for p in ring]
+    return {
+        'bounds': {'minx': min(xs), 'miny': min(ys), 'maxx': max(xs), 'maxy': max(ys)},
+        'geometry': geometry,
+        'hazard': hazard,
+    }
+
+
+def make_zones(seed=1, count=400):
+    rng = random.Random(seed)
+    zones = []
+    for i in range(count):
+        cx = rng.uniform(-9.5e6, -8.5e6)
+        cy = rng.uniform(3.5e6, 4.5e6)
+        # A few zones far larger than the rest go up to a coarser grid level
+        radius = 3e5 if i % 100 == 0 else rng.choice([2e3, 1e4, 3e4])
+        # Vertex counts either side of NUMPY_RING_MIN_VERTICES
+        n = rng.choice([5, 12, 40, 300])
+        rings = [star_ring(rng, cx, cy, radius, n)]
+        if rng.random() < 0.25:
+            rings.append(star_ring(rng, cx, cy, radius * 0.2, 8))
+        if rng.random() < 0.15:
+            geometry = {'type': 'MultiPolygon', 'coordinates': [
+                rings, [star_ring(rng, cx + 3 * radius, cy, radius, rng.choice([6, 200]))],
+            ]}
+        else:
+            geometry = {'type': 'Polygon', 'coordinates': rings}
+        zones.append(make_zone(geometry, rng.choice(HAZARDS)))
+    zones.append(make_zone({'type': 'Polygon', 'coordinates': [pentagram_ring(*STAR_CENTRE, 5e3)]}, 'STAR'))
+    # Zones whose geometry is null or has no coordinates match nothing but
+    # must not stop the rest of the file from loading
+    zones.append(dict(zones[0], geometry=None, hazard='NULL'))
+    zones.append(dict(zones[0], geometry={'type': 'Polygon'}, hazard='EMPTY'))
+    return zones
+
+
+def winding_number(x, y, ring):
+    winding = 0
+    for (x1, y1), (x2, y2) in zip([ring[-1]] + ring[:-1], ring):
+        is_left = (x2 - x1) * (y - y1) - (x - x1) * (y2 - y1)
+        if y1 <= y < y2 and is_left > 0:
+            winding += 1
+        elif y2 <= y < y1 and is_left < 0:
+            winding -= 1
+    return winding
+
+
+def reference_hazard(lat, lon, zones):
+    x, y = flood.lat_lon_to_web_mercator(lat, lon)
+    for zone in zones:
+        geometry = zone['geometry']
+        if geometry is None:
+            continue
+        coordinates = geometry.get('coordinates', [])
+        polygons = [coordinates] if geometry['type'] == 'Polygon' else coordinates
+        for polygon in polygons:
+            for ring in polygon:
+                if winding_number(x, y, ring) != 0:
+                    return zone['hazard']
+    return None
+
+
+def to_lat_lon(x, y):
+    return math.degrees(2 * math.atan(math.exp(y / R)) - math.pi / 2), math.degrees(x / R)
+
+
+def build_index(zones, grid_min_features, numpy_min_vertices):
+    flood_data = msgspec.convert(zones, type=list[flood.FloodZone])
+    with contextlib.redirect_stdout(io.StringIO()):
+        flood.prepare_rings(flood_data, numpy_min_vertices)
+        return flood.build_flood_index(flood_data, grid_min_features)
+
+
+class FindFloodHazardTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.zones = make_zones()
+        rng = random.Random(7)
+        points = []
+        for zone in cls.zones:
+            b = zone['bounds']
+            for _ in range(3):
+                points.append(to_lat_lon(rng.uniform(b['minx'], b['maxx']), rng.uniform(b['miny'], b['maxy'])))
+        points += [to_lat_lon(rng.uniform(-9.8e6, -8.2e6), rng.uniform(3.2e6, 4.8e6)) for _ in range(300)]
+        points += [to_lat_lon(*STAR_CENTRE), (0.0, 0.0)]
+        cls.points = points
+        cls.expected = [reference_hazard(lat, lon, cls.zones) for lat, lon in points]
+
+    def check_variant(self, grid_min_features, numpy_min_vertices):
+        flood_index = build_index(self.zones, grid_min_features, numpy_min_vertices)
+        with contextlib.redirect_stdout(io.StringIO()):
+            got = [flood.find_flood_hazard(lat, lon, flood_index) for lat, lon in self.points]
+        mismatches = [
+            (point, want, have)
+            for point, want, have in zip(self.points, self.expected, got) if want != have
+        ]
+        self.assertEqual(mismatches, [])
+        return flood_index
+
+    def test_grid_list_kernel(self):
+        flood_index = self.check_variant(0, sys.maxsize)
+        self.assertIsNotNone(flood_index.grid)
+        self.assertGreater(len(flood_index.grid), 1)
+
+    def test_grid_numpy_kernel(self):
+        self.check_variant(0, 0)
+
+    def test_sorted_scan_list_kernel(self):
+        flood_index = self.check_variant(sys.maxsize, sys.maxsize)
+        self.assertIsNone(flood_index.grid)
+
+    def test_sorted_scan_numpy_kernel(self):
+        self.check_variant(sys.maxsize, 0)
+
+    def test_default_thresholds(self):
+        self.check_variant(flood.GRID_MIN_FEATURES, flood.NUMPY_RING_MIN_VERTICES)
+
+    def test_reference_covers_edge_cases(self):
+        self.assertEqual(self.expected[-2], 'STAR')
+        self.assertIsNone(self.expected[-1])
+        geometries = [z['geometry'] for z in self.zones]
+        self.assertIn(None, geometries)
+        self.assertTrue(any(g and g['type'] == 'MultiPolygon' for g in geometries))
+        self.assertTrue(any(len(g.get('coordinates', [])) > 1 for g in geometries
+                            if g and g['type'] == 'Polygon'))
+        self.assertGreater(sum(h is not None for h in self.expected), len(self.points) // 3)
+
+
+if __name__ == '__main__':
+    unittest.main()